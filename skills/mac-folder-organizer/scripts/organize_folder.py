@@ -18,9 +18,14 @@ from __future__ import annotations
 
 import argparse
 import csv
+import errno
+import functools
 import os
+import re
 import shutil
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
@@ -46,6 +51,15 @@ COMPOUND_EXTS = [
     ".tgz", ".tbz2", ".txz"
 ]
 
+# longest first so .tar.gz wins over .gz-style endings
+_COMPOUND_EXTS_SORTED = tuple(sorted(COMPOUND_EXTS, key=len, reverse=True))
+_COMPOUND_RE = re.compile(
+    r"(" + "|".join(re.escape(e) for e in _COMPOUND_EXTS_SORTED) + r")\Z",
+    re.IGNORECASE,
+)
+# last suffix of each compound ext (.gz, .tgz, ...); only these need the regex
+_COMPOUND_TAILS = frozenset(e[e.rfind("."):] for e in COMPOUND_EXTS)
+
 EXT_MAP: Dict[str, Set[str]] = {
     CAT_TABLE: {".xls", ".xlsx", ".csv", ".tsv", ".ods", ".numbers"},
     CAT_CODE: {
@@ -65,6 +79,14 @@ EXT_MAP: Dict[str, Set[str]] = {
     CAT_PRESENT: {".ppt", ".pptx", ".key", ".odp"},
 }
 
+# ext -> category, for a single lookup per file in classify()
+EXT_TO_CAT: Dict[str, str] = {ext: cat for cat, exts in EXT_MAP.items() for ext in exts}
+
+LOG_BUFFER_SIZE = 1 << 20
+LOG_BATCH_ROWS = 64
+# moves are independent syscalls (a cross-device move is a full copy), so run several at once
+MOVE_WORKERS = 8
+
 # 默认不动目录；可用 --include-packages 把 iWork 包（.pages/.numbers/.key）当作可移动对象
 DEFAULT_PACKAGE_DIR_EXTS = {".pages", ".numbers", ".key"}
 
@@ -77,44 +99,44 @@ class PlanItem:
 def now_stamp() -> str:
     return datetime.now().strftime("%Y%m%d-%H%M%S")
 
-def is_hidden(path: Path) -> bool:
-    return path.name.startswith(".")
+def is_hidden(name: str) -> bool:
+    return name.startswith(".")
 
 def match_compound_ext(name_lower: str) -> Optional[str]:
-    for ext in sorted(COMPOUND_EXTS, key=len, reverse=True):
-        if name_lower.endswith(ext):
-            return ext
-    return None
+    m = _COMPOUND_RE.search(name_lower)
+    return m.group(1) if m else None
 
 def split_base_ext(name: str) -> Tuple[str, str]:
-    nl = name.lower()
-    cext = match_compound_ext(nl)
-    if cext:
-        return name[: -len(cext)], name[-len(cext):]
-    p = Path(name)
-    ext = p.suffix
-    if ext:
-        return name[: -len(ext)], ext
+    head, dot, tail = name.rpartition(".")
+    ext = dot + tail
+    if ext.lower() in _COMPOUND_TAILS:
+        cext = match_compound_ext(name.lower())
+        if cext:
+            return name[: -len(cext)], name[-len(cext):]
+    # same rule as Path.suffix: no suffix for dotfiles or a trailing dot
+    if head and tail:
+        return head, ext
     return name, ""
 
-def ext_token(path: Path) -> str:
-    _, ext = split_base_ext(path.name)
+# The scan/classify hot path works on plain str names and paths;
+# Path objects are only built for PlanItem.
+
+def ext_token(name: str) -> str:
+    _, ext = split_base_ext(name)
     return ext.lower()
 
-def classify(path: Path) -> Optional[str]:
-    name_lower = path.name.lower()
-    if name_lower in {"dockerfile", "makefile"}:
-        return CAT_CODE
-    if name_lower.startswith("dockerfile"):
+@functools.lru_cache(maxsize=None)
+def _classify_by_ext(ext: str) -> Optional[str]:
+    # keyed on the raw extension so its lower() is cached too
+    return EXT_TO_CAT.get(ext.lower())
+
+def classify(name: str) -> Optional[str]:
+    # the whole-name special cases only need the first 10 chars lower-cased
+    head = name[:10].lower()
+    if head == "makefile" or head.startswith("dockerfile"):
         return CAT_CODE
 
-    e = ext_token(path)
-    if not e:
-        return None
-    for cat, exts in EXT_MAP.items():
-        if e in exts:
-            return cat
-    return None
+    return _classify_by_ext(split_base_ext(name)[1])
 
 def iter_candidates(
     root: Path,
@@ -122,81 +144,98 @@ def iter_candidates(
     result_dir: Path,
     include_packages: bool,
     include_app: bool,
-) -> Iterable[Path]:
-    result_dir = result_dir.resolve()
-
-    def eligible(p: Path) -> bool:
-        try:
-            rp = p.resolve()
-        except Exception:
-            rp = p.absolute()
-
-        # 排除 分类结果 及其子树
-        if rp == result_dir or result_dir in rp.parents:
-            return False
-
-        if is_hidden(p):
-            return False
-
-        if p.is_file():
-            return True
-
-        # 可选：把 iWork 包目录当作可移动对象
-        if include_packages and p.is_dir():
-            e = ext_token(p)
-            if e in DEFAULT_PACKAGE_DIR_EXTS:
-                return True
-            if include_app and e == ".app":
-                return True
-
-        return False
-
-    if not recursive:
-        for p in root.iterdir():
-            if eligible(p):
-                yield p
+) -> Iterable[Tuple[Optional[str], str]]:
+    """
+    Eligible paths (as str) with their category (None if unclassified).
+    """
+    for name, p in _walk_scandir(root, recursive, result_dir.resolve(), include_packages, include_app):
+        yield classify(name), p
+
+def _walk_scandir(
+    root: Path,
+    recursive: bool,
+    result_dir: Path,
+    include_packages: bool,
+    include_app: bool,
+) -> Iterable[Tuple[str, str]]:
+    """
+    Yield (name, path) for root's entries (its whole subtree if recursive) with an explicit stack of
+    os.scandir() calls, so depth is not bounded by the recursion limit.
+    DirEntry.is_file()/is_dir() come from readdir's d_type, so normal entries
+    cost no extra stat.
+    """
+    result_str = str(result_dir)
+    result_prefix = result_str + os.sep
+
+    def in_result_dir(p: str) -> bool:
+        return p == result_str or p.startswith(result_prefix)
+
+    # 排除 分类结果 及其子树: it is never descended into, so below root only
+    # the directory entry itself (or a symlink into it) can match
+    if in_result_dir(str(root)):
         return
 
-    for dirpath, dirnames, filenames in os.walk(root):
-        dp = Path(dirpath)
-
-        # prune hidden dirs and result_dir
-        pruned = []
-        for d in list(dirnames):
-            dd = dp / d
-            if is_hidden(dd):
-                pruned.append(d)
-                continue
-            try:
-                rdd = dd.resolve()
-            except Exception:
-                rdd = dd.absolute()
-            if rdd == result_dir or result_dir in rdd.parents:
-                pruned.append(d)
-        for d in pruned:
-            dirnames.remove(d)
-
-        for fn in filenames:
-            p = dp / fn
-            if eligible(p):
-                yield p
-
-        if include_packages or include_app:
-            for d in dirnames:
-                p = dp / d
-                if eligible(p):
-                    yield p
-
-def unique_destination(dest: Path) -> Path:
-    if not dest.exists():
-        return dest
+    stack = [str(root)]
+    while stack:
+        d = stack.pop()
+        try:
+            it = os.scandir(d)
+        except OSError:
+            continue
+        with it:
+            for e in it:
+                if is_hidden(e.name):
+                    continue
+                if e.is_symlink() and in_result_dir(os.path.realpath(e.path)):
+                    continue
+
+                if e.is_file():
+                    yield e.name, e.path
+                    continue
+                if not e.is_dir() or e.path == result_str:
+                    continue
+
+                # 可选：把 iWork 包目录当作可移动对象（不再深入其内部）
+                if include_packages:
+                    ext = ext_token(e.name)
+                    if ext in DEFAULT_PACKAGE_DIR_EXTS or (include_app and ext == ".app"):
+                        yield e.name, e.path
+                        continue
+
+                # like os.walk: list symlinked dirs but never descend into them
+                if recursive and not e.is_symlink():
+                    stack.append(e.path)
+
+def dir_names(d: Path) -> Set[str]:
+    """
+    Lower-cased names in d (empty if d does not exist yet).
+    Lower-cased because APFS/HFS+ are case-insensitive by default.
+    """
+    try:
+        with os.scandir(d) as it:
+            return {e.name.lower() for e in it}
+    except OSError:
+        return set()
+
+def unique_destination(dest: Path, used: Dict[Path, Set[str]]) -> Path:
+    """
+    Suffix _001, _002... until dest is free.
+    `used` maps dest dir -> taken names (filled lazily from disk); the search is
+    done in memory and the chosen name is reserved for later plan items.
+    """
     base, ext = split_base_ext(dest.name)
+
+    names = used.get(dest.parent)
+    if names is None:
+        names = used[dest.parent] = dir_names(dest.parent)
+
+    name = dest.name
     i = 1
-    while True:
-        candidate = dest.with_name(f"{base}_{i:03d}{ext}")
-        if not candidate.exists():
-            return candidate
+    while name.lower() in names:
+        name = f"{base}_{i:03d}{ext}"
         i += 1
+    names.add(name.lower())
+    return dest.with_name(name)
 
 def build_plan(
     root: Path,
@@ -210,38 +249,52 @@ def build_plan(
     result_dir = (root / result_dir_name).resolve()
 
     counts: Dict[str, int] = {c: 0 for c in CATEGORIES}
-    plan: List[PlanItem] = []
-    unclassified_list: List[Path] = []
+    used_names: Dict[Path, Set[str]] = {}
 
-    candidates = list(iter_candidates(
+    # bucket by category while scanning; None collects the unclassified
+    buckets: Dict[Optional[str], List[str]] = {}
+    for cat, p in iter_candidates(
         root=root,
         recursive=recursive,
         result_dir=result_dir,
         include_packages=include_packages,
         include_app=include_app,
-    ))
-    candidates.sort(key=lambda p: p.as_posix().lower())
-
-    for p in candidates:
-        cat = classify(p)
-        if not cat:
-            unclassified_list.append(p)
-            continue
-
-        dest_dir = result_dir / cat
-        if flatten:
-            dest = dest_dir / p.name
-        else:
-            rel_parent = p.parent.relative_to(root)
-            dest = dest_dir / rel_parent / p.name
-
-        dest = unique_destination(dest)
-        plan.append(PlanItem(old_path=p, new_path=dest, category=cat))
-        counts[cat] += 1
+    ):
+        buckets.setdefault(cat, []).append(p)
+
+    def posix_key(p: str) -> str:
+        # same order as Path.as_posix().lower()
+        return p.replace(os.sep, "/").lower()
+
+    unclassified_list = [Path(p) for p in sorted(buckets.pop(None, []), key=posix_key)]
+
+    # join adds a separator only when missing, so "/" and "D:\\" work too
+    root_len = len(os.path.join(str(root), ""))
+
+    # every category has its own destination dir, so each bucket is planned
+    # (and sorted) on its own
+    planned: Dict[str, List[PlanItem]] = {}
+    for cat, paths in buckets.items():
+        paths.sort(key=posix_key)
+        dest_dir = os.path.join(str(result_dir), cat)
+        items: List[PlanItem] = []
+        for p in paths:
+            parent, name = os.path.split(p)
+            if flatten:
+                dest = os.path.join(dest_dir, name)
+            else:
+                # paths come from scanning root, so parent starts with root's prefix
+                dest = os.path.join(dest_dir, parent[root_len:], name)
+
+            new_path = unique_destination(Path(dest), used_names)
+            items.append(PlanItem(old_path=Path(p), new_path=new_path, category=cat))
+        counts[cat] += len(items)
+        planned[cat] = items
 
     dirs_to_create: Set[Path] = {result_dir, result_dir / "_logs"}
-    for it in plan:
-        dirs_to_create.add(it.new_path.parent)
+    for items in planned.values():
+        for it in items:
+            dirs_to_create.add(it.new_path.parent)
 
     dirs_sorted = sorted(dirs_to_create, key=lambda p: p.as_posix().lower())
 
@@ -249,35 +302,88 @@ def build_plan(
     if unclassified == "move" and unclassified_list:
         uc_dir = result_dir / CAT_OTHER
         dirs_sorted.append(uc_dir)
-        for p in unclassified_list:
-            dest = unique_destination(uc_dir / p.name)
-            plan.append(PlanItem(old_path=p, new_path=dest, category=CAT_OTHER))
+        planned[CAT_OTHER] = [
+            PlanItem(old_path=p, new_path=unique_destination(uc_dir / p.name, used_names), category=CAT_OTHER)
+            for p in unclassified_list
+        ]
 
-    plan.sort(key=lambda it: (it.category, it.old_path.name.lower()))
+    plan: List[PlanItem] = []
+    for cat in sorted(planned):
+        items = planned[cat]
+        items.sort(key=lambda it: it.old_path.name.lower())
+        plan.extend(items)
     return plan, dirs_sorted, counts, unclassified_list, result_dir
 
+def move_path(src: Path, dst: Path) -> None:
+    """
+    A same-volume move is a single rename(2); only a cross-device move
+    falls back to shutil.move (copy + delete).
+    """
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(str(src), str(dst))
+
 def write_log_header(w: csv.writer) -> None:
     w.writerow(["category", "old_path", "new_path", "status", "error"])
 
-def apply_plan(plan: List[PlanItem], log_path: Path) -> None:
+def apply_plan(
+    plan: List[PlanItem],
+    dirs_to_create: List[Path],
+    log_path: Path,
+    sync_log: bool = False,
+) -> None:
+    # create every destination dir once up front (build_plan collected them)
+    for d in dirs_to_create:
+        d.mkdir(parents=True, exist_ok=True)
     log_path.parent.mkdir(parents=True, exist_ok=True)
-    with log_path.open("w", newline="", encoding="utf-8") as f:
+    # Plan targets are already unique. A target that appeared since planning gets a
+    # new name, picked under a lock so it avoids every plan target and other new names.
+    reserved: Dict[Path, Set[str]] = {}
+    for it in plan:
+        reserved.setdefault(it.new_path.parent, set()).add(it.new_path.name.lower())
+    reserve_lock = threading.Lock()
+
+    def move_one(it: PlanItem) -> List[str]:
+        try:
+            if it.new_path.exists():
+                with reserve_lock:
+                    reserved[it.new_path.parent].update(dir_names(it.new_path.parent))
+                    it = PlanItem(it.old_path, unique_destination(it.new_path, reserved), it.category)
+
+            move_path(it.old_path, it.new_path)
+            return [it.category, str(it.old_path), str(it.new_path), "moved", ""]
+        except Exception as e:
+            return [it.category, str(it.old_path), str(it.new_path), "failed", repr(e)]
+
+    # block-buffered log written LOG_BATCH_ROWS rows at a time; rows stay in plan
+    # order because undo replays the log in reverse. sync_log writes and flushes every row
+    batch = 1 if sync_log else LOG_BATCH_ROWS
+    with log_path.open("w", newline="", encoding="utf-8", buffering=LOG_BUFFER_SIZE) as f, \
+            ThreadPoolExecutor(max_workers=MOVE_WORKERS) as pool:
         w = csv.writer(f)
         write_log_header(w)
-        f.flush()
-
-        for it in plan:
-            try:
-                it.new_path.parent.mkdir(parents=True, exist_ok=True)
-                if it.new_path.exists():
-                    it = PlanItem(it.old_path, unique_destination(it.new_path), it.category)
 
-                shutil.move(str(it.old_path), str(it.new_path))
-                w.writerow([it.category, str(it.old_path), str(it.new_path), "moved", ""])
-            except Exception as e:
-                w.writerow([it.category, str(it.old_path), str(it.new_path), "failed", repr(e)])
-            finally:
-                f.flush()
+        rows: List[List[str]] = []
+        futures = [pool.submit(move_one, it) for it in plan]
+        logged = 0
+        try:
+            for fut in futures:
+                rows.append(fut.result())
+                logged += 1
+                if len(rows) >= batch:
+                    w.writerows(rows)
+                    rows.clear()
+                    if sync_log:
+                        f.flush()
+        finally:
+            # if interrupted: drop queued moves, but still log the ones already running
+            for fut in futures[logged:]:
+                if not fut.cancel():
+                    rows.append(fut.result())
+            w.writerows(rows)
 
 def undo_from_log(log_path: Path, apply: bool) -> int:
     if not log_path.exists():
@@ -285,11 +391,19 @@ def undo_from_log(log_path: Path, apply: bool) -> int:
 
     rows: List[Tuple[str, Path, Path]] = []
     with log_path.open("r", newline="", encoding="utf-8") as f:
-        r = csv.DictReader(f)
-        for row in r:
-            if row.get("status") != "moved":
-                continue
-            rows.append((row.get("category", ""), Path(row["old_path"]), Path(row["new_path"])))
+        r = csv.reader(f)
+        header = next(r, None)
+        if header is not None:
+            # column positions from the header, so older/reordered logs still work
+            idx = {name: i for i, name in enumerate(header)}
+            i_status = idx.get("status")
+            i_cat = idx.get("category")
+            i_old, i_new = idx["old_path"], idx["new_path"]
+            for row in r:
+                if i_status is None or i_status >= len(row) or row[i_status] != "moved":
+                    continue
+                cat = row[i_cat] if i_cat is not None else ""
+                rows.append((cat, Path(row[i_old]), Path(row[i_new])))
 
     rows.reverse()
     changed = 0
@@ -304,7 +418,7 @@ def undo_from_log(log_path: Path, apply: bool) -> int:
         print(f"[UNDO] {new_p} -> {old_p} (cat={cat})")
         if apply:
             old_p.parent.mkdir(parents=True, exist_ok=True)
-            shutil.move(str(new_p), str(old_p))
+            move_path(new_p, old_p)
         changed += 1
     return changed
 
@@ -321,6 +435,7 @@ def main() -> int:
     ap.add_argument("--dry-run", action="store_true", help="Preview only (default if --apply is not provided).")
     ap.add_argument("--apply", action="store_true", help="Actually move files.")
     ap.add_argument("--undo", type=str, help="Undo using a CSV log file. Use with --apply to actually undo.")
+    ap.add_argument("--sync-log", action="store_true", help="Flush the CSV log after every move (slower, but current even if killed).")
     ap.add_argument("--max-preview", type=int, default=80, help="Max preview lines to print.")
     args = ap.parse_args()
 
@@ -394,7 +509,7 @@ def main() -> int:
 
     log_path = (result_dir / "_logs" / f"sort-log-{now_stamp()}.csv").resolve()
     print(f"\nApplying moves... Log: {log_path}")
-    apply_plan(plan, log_path=log_path)
+    apply_plan(plan, dirs_to_create=dirs_to_create, log_path=log_path, sync_log=bool(args.sync_log))
     print("Done.")
     print(f"Log saved to: {log_path}")
     print("To undo: rerun with --undo <log.csv> --apply")
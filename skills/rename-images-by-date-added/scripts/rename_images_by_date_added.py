@@ -8,27 +8,42 @@ Rename image files by macOS "Date Added" (kMDItemDateAdded) with fallback to bir
 - Writes a CSV log for undo
 - Supports --undo to revert using a previous log
 
-Designed primarily for macOS. On other OSes, mdls is not available and the script will fall back.
+Designed primarily for macOS. Date Added is read in-process where possible (xattr, or
+Spotlight via pyobjc if installed), then via mdls. On other OSes, mdls is not available
+and the script will fall back.
 """
 
 from __future__ import annotations
 
 import argparse
 import csv
+import ctypes
+import ctypes.util
+import functools
 import os
+import plistlib
 import re
+import shutil
 import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import Iterable, Optional, Tuple, List
+from typing import Dict, Iterable, Optional, Tuple, List
 
 DEFAULT_EXTS = {
     ".jpg", ".jpeg", ".png", ".gif", ".heic", ".heif", ".webp",
     ".tif", ".tiff", ".bmp"
 }
 
+# Per-file metadata lookups are syscall/IO bound, so threads overlap them well.
+# One pool is shared by all calls.
+_POOL = ThreadPoolExecutor(max_workers=16)
+
+LOG_BUFFER_SIZE = 1 << 20
+LOG_BATCH_ROWS = 64
+
 @dataclass(frozen=True)
 class PlanItem:
     old_path: Path
@@ -49,11 +64,27 @@ def _normalize_exts(exts: Optional[List[str]]) -> set[str]:
         out.add(e)
     return out if out else set(DEFAULT_EXTS)
 
-def _iter_files(root: Path, recursive: bool) -> Iterable[Path]:
-    if recursive:
-        yield from (p for p in root.rglob("*") if p.is_file())
-    else:
-        yield from (p for p in root.iterdir() if p.is_file())
+def _iter_entries(root: Path, recursive: bool, exts: set[str]) -> Iterable[os.DirEntry]:
+    """
+    Non-hidden files under root whose extension is in exts.
+    Yields DirEntry objects so the stat() needed for timestamps is done once per file.
+    """
+    stack = [str(root)]
+    while stack:
+        d = stack.pop()
+        try:
+            it = os.scandir(d)
+        except OSError:
+            continue
+        with it:
+            for e in it:
+                if recursive and e.is_dir(follow_symlinks=False):
+                    stack.append(e.path)
+                    continue
+                if e.name.startswith("."):
+                    continue
+                if os.path.splitext(e.name)[1].lower() in exts and e.is_file():
+                    yield e
 
 def _parse_mdls_date(s: str) -> Optional[float]:
     """
@@ -102,8 +133,171 @@ def _get_date_added_mdls(path: Path) -> Optional[float]:
 
     return _parse_mdls_date(proc.stdout)
 
-def _get_birthtime(path: Path) -> Optional[float]:
-    st = path.stat()
+DATE_ADDED_XATTR = "com.apple.metadata:kMDItemDateAdded"
+
+@functools.lru_cache(maxsize=None)
+def _libc():
+    """
+    libc handle for getxattr(2) on macOS, where os.getxattr is not provided.
+    """
+    if sys.platform != "darwin":
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    except OSError:
+        return None
+    libc.getxattr.argtypes = [
+        ctypes.c_char_p, ctypes.c_char_p, ctypes.c_void_p,
+        ctypes.c_size_t, ctypes.c_uint32, ctypes.c_int,
+    ]
+    libc.getxattr.restype = ctypes.c_ssize_t
+    return libc
+
+def _getxattr(path: Path, name: str) -> Optional[bytes]:
+    if hasattr(os, "getxattr"):
+        try:
+            return os.getxattr(path, name)
+        except OSError:
+            return None
+
+    libc = _libc()
+    if libc is None:
+        return None
+    p = os.fsencode(path)
+    n = name.encode("utf-8")
+    size = libc.getxattr(p, n, None, 0, 0, 0)
+    if size <= 0:
+        return None
+    buf = ctypes.create_string_buffer(size)
+    size = libc.getxattr(p, n, buf, size, 0, 0)
+    if size <= 0:
+        return None
+    return buf.raw[:size]
+
+@functools.lru_cache(maxsize=None)
+def _mditem_api():
+    """
+    (MDItemCreate, MDItemCopyAttribute) from pyobjc's CoreServices, or None if not installed.
+    """
+    try:
+        from CoreServices import MDItemCopyAttribute, MDItemCreate
+    except ImportError:
+        return None
+    return MDItemCreate, MDItemCopyAttribute
+
+def _get_date_added_native(path: Path) -> Optional[float]:
+    """
+    Read kMDItemDateAdded without spawning a process:
+    the com.apple.metadata xattr first, then Spotlight via pyobjc.
+    Returns epoch seconds float or None.
+    """
+    raw = _getxattr(path, DATE_ADDED_XATTR)
+    if raw is not None:
+        try:
+            value = plistlib.loads(raw)
+        except Exception:
+            value = None
+        if isinstance(value, datetime):
+            # plist dates are UTC
+            if value.tzinfo is None:
+                value = value.replace(tzinfo=timezone.utc)
+            return value.timestamp()
+
+    api = _mditem_api()
+    if api is None:
+        return None
+    create, copy_attribute = api
+    item = create(None, str(path))
+    if item is None:
+        return None
+    date = copy_attribute(item, "kMDItemDateAdded")
+    if date is None:
+        return None
+    return float(date.timeIntervalSince1970())
+
+MDLS_BATCH_SIZE = 256
+
+# Runs under `xargs -0 sh -c`: one mdls per path, each value NUL-terminated
+# (empty if mdls fails), so the output always lines up with the input.
+_MDLS_EACH_SH = 'for f; do mdls -name kMDItemDateAdded -raw "$f" 2>/dev/null; printf "\\0"; done'
+
+def _get_dates_added_mdls_each(paths: List[Path]) -> List[Optional[float]]:
+    """
+    Per-file mdls for paths whose batched output could not be aligned.
+    The paths are fed to a single xargs child over stdin, so Python spawns
+    one process for the whole list instead of one per file.
+    """
+    try:
+        proc = subprocess.run(
+            ["xargs", "-0", "sh", "-c", _MDLS_EACH_SH, "sh"],
+            input="\0".join(str(p) for p in paths),
+            capture_output=True,
+            text=True,
+            check=False,
+        )
+    except FileNotFoundError:
+        return [_get_date_added_mdls(p) for p in paths]
+
+    values = proc.stdout.split("\0")
+    if len(values) != len(paths) + 1:
+        return [_get_date_added_mdls(p) for p in paths]
+    return [_parse_mdls_date(v) for v in values[:-1]]
+
+def _get_dates_added_mdls_batch(paths: List[Path]) -> List[Optional[float]]:
+    """
+    Read kMDItemDateAdded for many files with one mdls call per chunk.
+    mdls -raw separates the values of multiple files with NUL.
+    Returns epoch seconds (or None) aligned with `paths`.
+    """
+    out: List[Optional[float]] = []
+    for i in range(0, len(paths), MDLS_BATCH_SIZE):
+        chunk = paths[i:i + MDLS_BATCH_SIZE]
+        try:
+            proc = subprocess.run(
+                ["mdls", "-name", "kMDItemDateAdded", "-raw", *(str(p) for p in chunk)],
+                capture_output=True,
+                text=True,
+                check=False,
+            )
+        except FileNotFoundError:
+            # mdls not available (non-macOS); nothing more to try
+            out.extend([None] * (len(paths) - i))
+            break
+
+        values = proc.stdout.split("\0")
+        if len(values) == len(chunk) + 1 and not values[-1].strip():
+            values.pop()
+
+        if proc.returncode != 0 or len(values) != len(chunk):
+            # a failing file shifts the output; fall back to one mdls per file
+            out.extend(_get_dates_added_mdls_each(chunk))
+            continue
+
+        out.extend(_parse_mdls_date(v) for v in values)
+
+    return out
+
+@functools.lru_cache(maxsize=None)
+def _have_mdls() -> bool:
+    return shutil.which("mdls") is not None
+
+def _get_dates_added(paths: List[Path]) -> List[Optional[float]]:
+    """
+    kMDItemDateAdded for each path: native lookup first, mdls only for the rest.
+    """
+    dates = list(_POOL.map(_get_date_added_native, paths, chunksize=32))
+    if _mditem_api() is not None:
+        # Spotlight already answered in-process; mdls would not know more
+        return dates
+
+    missing = [i for i, d in enumerate(dates) if d is None]
+    if missing and _have_mdls():
+        found = _get_dates_added_mdls_batch([paths[i] for i in missing])
+        for i, d in zip(missing, found):
+            dates[i] = d
+    return dates
+
+def _get_birthtime(st: os.stat_result) -> Optional[float]:
     # macOS typically provides st_birthtime
     bt = getattr(st, "st_birthtime", None)
     if bt is None:
@@ -111,42 +305,43 @@ def _get_birthtime(path: Path) -> Optional[float]:
     # st_birthtime is seconds (float)
     return float(bt)
 
-def _get_mtime(path: Path) -> float:
-    return float(path.stat().st_mtime)
+def _get_mtime(st: os.stat_result) -> float:
+    return float(st.st_mtime)
 
-def _timestamp_ms_for_file(path: Path, source: str) -> Tuple[int, str]:
+def _timestamp_ms_for_entry(entry: os.DirEntry, source: str, date_added: Optional[float] = None) -> Tuple[int, str]:
     """
     source:
       - auto: try date-added, else birthtime, else mtime
       - date-added: mdls only; fallback to birthtime/mtime if missing
       - birthtime: birthtime only; fallback to mtime if missing
       - mtime: mtime only
+
+    date_added is the kMDItemDateAdded value already fetched by the caller
+    (see _get_dates_added); None means it is missing.
+    Birthtime and mtime both come from entry.stat(), which is cached on the entry.
     """
     source = source.lower()
 
     if source not in {"auto", "date-added", "birthtime", "mtime"}:
         raise ValueError(f"Unsupported source: {source}")
 
-    if source in {"auto", "date-added"}:
-        da = _get_date_added_mdls(path)
-        if da is not None:
-            return int(round(da * 1000)), "date-added"
+    if source in {"auto", "date-added"} and date_added is not None:
+        return int(round(date_added * 1000)), "date-added"
 
-        if source == "date-added":
-            # explicit request, but still avoid failing hard
-            bt = _get_birthtime(path)
-            if bt is not None:
-                return int(round(bt * 1000)), "birthtime"
-            return int(round(_get_mtime(path) * 1000)), "mtime"
+    st = entry.stat()
 
-    if source in {"auto", "birthtime"}:
-        bt = _get_birthtime(path)
+    # date-added: explicit request, but still avoid failing hard
+    if source in {"auto", "date-added", "birthtime"}:
+        bt = _get_birthtime(st)
         if bt is not None:
             return int(round(bt * 1000)), "birthtime"
-        return int(round(_get_mtime(path) * 1000)), "mtime"
 
-    # mtime
-    return int(round(_get_mtime(path) * 1000)), "mtime"
+    return int(round(_get_mtime(st) * 1000)), "mtime"
+
+@functools.lru_cache(maxsize=None)
+def _sec_str(sec: int) -> str:
+    # burst photos share seconds; format each second only once
+    return datetime.fromtimestamp(sec).strftime("%Y%m%d%H%M%S")
 
 def _format_name(ts_ms: int, fmt: str, prefix: str = "") -> str:
     """
@@ -154,35 +349,46 @@ def _format_name(ts_ms: int, fmt: str, prefix: str = "") -> str:
     prefix is typically the folder name.
     """
     fmt = fmt.lower()
-    dt = datetime.fromtimestamp(ts_ms / 1000.0)
     # Always use datetime format: YYYYMMDDHHMMSSmmm (精确到毫秒)
-    time_str = dt.strftime("%Y%m%d%H%M%S") + f"{ts_ms % 1000:03d}"
+    time_str = _sec_str(ts_ms // 1000) + f"{ts_ms % 1000:03d}"
 
     if prefix:
         return f"{prefix}_{time_str}"
     return time_str
 
+def _dir_names(d: Path) -> set[str]:
+    """
+    Lower-cased names in d (empty if unreadable).
+    Lower-cased because APFS/HFS+ are case-insensitive by default.
+    """
+    try:
+        with os.scandir(d) as it:
+            return {e.name.lower() for e in it}
+    except OSError:
+        return set()
+
 def _unique_target_name(
     target_dir: Path,
     base: str,
     ext: str,
-    used: set[str]
+    used: Dict[Path, set[str]]
 ) -> str:
     """
     Ensure uniqueness within the batch and on filesystem by suffixing _001, _002...
+    `used` maps each directory to its taken names; a directory is listed once on
+    first use and every chosen name is reserved in it.
     """
-    candidate = f"{base}{ext}"
-    if candidate not in used and not (target_dir / candidate).exists():
-        used.add(candidate)
-        return candidate
+    names = used.get(target_dir)
+    if names is None:
+        names = used[target_dir] = _dir_names(target_dir)
 
+    candidate = f"{base}{ext}"
     i = 1
-    while True:
+    while candidate.lower() in names:
         candidate = f"{base}_{i:03d}{ext}"
-        if candidate not in used and not (target_dir / candidate).exists():
-            used.add(candidate)
-            return candidate
         i += 1
+    names.add(candidate.lower())
+    return candidate
 
 def build_plan(
     root: Path,
@@ -192,22 +398,26 @@ def build_plan(
     keep_original: bool,
     time_source: str,
 ) -> List[PlanItem]:
-    files: List[Path] = []
-    for p in _iter_files(root, recursive):
-        if p.name.startswith("."):
-            continue
-        if p.suffix.lower() in exts:
-            files.append(p)
+    entries = list(_iter_entries(root, recursive, exts))
+    files = [Path(e.path) for e in entries]
+
+    if time_source.lower() in {"auto", "date-added"}:
+        dates_added = _get_dates_added(files)
+    else:
+        dates_added = [None] * len(files)
 
-    items: List[Tuple[Path, int, str]] = []
-    for p in files:
-        ts_ms, src = _timestamp_ms_for_file(p, time_source)
-        items.append((p, ts_ms, src))
+    items: List[Tuple[Path, int, str]] = list(_POOL.map(
+        lambda p, e, da: (p, *_timestamp_ms_for_entry(e, time_source, da)),
+        files,
+        entries,
+        dates_added,
+        chunksize=32,
+    ))
 
     # Sort for stability
     items.sort(key=lambda x: (x[1], x[0].name.lower()))
 
-    used_names: set[str] = set()
+    used_names: Dict[Path, set[str]] = {}
     plan: List[PlanItem] = []
     for old_path, ts_ms, src in items:
         target_dir = old_path.parent
@@ -238,18 +448,29 @@ def write_csv_log(log_path: Path, plan: List[PlanItem]) -> None:
         for it in plan:
             w.writerow([str(it.old_path), str(it.new_path), it.timestamp_ms, it.source])
 
-def apply_plan(plan: List[PlanItem], log_path: Path) -> None:
+def apply_plan(plan: List[PlanItem], log_path: Path, sync_log: bool = False) -> None:
     # Write log AFTER each successful rename to avoid recording actions that didn't happen.
+    # Rows are written LOG_BATCH_ROWS at a time into a block-buffered file; pending
+    # rows are still written when a rename raises. sync_log writes and flushes every row.
+    batch = 1 if sync_log else LOG_BATCH_ROWS
     log_path.parent.mkdir(parents=True, exist_ok=True)
-    with log_path.open("w", newline="", encoding="utf-8") as f:
+    with log_path.open("w", newline="", encoding="utf-8", buffering=LOG_BUFFER_SIZE) as f:
         w = csv.writer(f)
         w.writerow(["old_path", "new_path", "timestamp_ms", "source"])
-        for it in plan:
-            if it.new_path.exists():
-                raise FileExistsError(f"Target already exists: {it.new_path}")
-            it.old_path.rename(it.new_path)
-            w.writerow([str(it.old_path), str(it.new_path), it.timestamp_ms, it.source])
-            f.flush()
+        rows: List[list] = []
+        try:
+            for it in plan:
+                if it.new_path.exists():
+                    raise FileExistsError(f"Target already exists: {it.new_path}")
+                it.old_path.rename(it.new_path)
+                rows.append([str(it.old_path), str(it.new_path), it.timestamp_ms, it.source])
+                if len(rows) >= batch:
+                    w.writerows(rows)
+                    rows.clear()
+                    if sync_log:
+                        f.flush()
+        finally:
+            w.writerows(rows)
 
 def undo_from_log(log_path: Path, apply: bool) -> int:
     if not log_path.exists():
@@ -257,11 +478,18 @@ def undo_from_log(log_path: Path, apply: bool) -> int:
 
     rows: List[Tuple[Path, Path]] = []
     with log_path.open("r", newline="", encoding="utf-8") as f:
-        r = csv.DictReader(f)
-        for row in r:
-            old_p = Path(row["old_path"])
-            new_p = Path(row["new_path"])
-            rows.append((old_p, new_p))
+        r = csv.reader(f)
+        header = next(r, None)
+        if header is not None:
+            # column positions from the header, so older/reordered logs still work
+            idx = {name: i for i, name in enumerate(header)}
+            i_old, i_new = idx["old_path"], idx["new_path"]
+            for row in r:
+                if not row:
+                    continue
+                old_p = Path(row[i_old])
+                new_p = Path(row[i_new])
+                rows.append((old_p, new_p))
 
     # reverse to safely undo in case of cascades
     rows.reverse()
@@ -298,6 +526,7 @@ def main() -> int:
     ap.add_argument("--apply", action="store_true", help="Actually rename files.")
     ap.add_argument("--log", type=str, help="CSV log path. Default: in target directory.")
     ap.add_argument("--undo", type=str, help="Undo using a previous CSV log. Use with --apply to actually undo.")
+    ap.add_argument("--sync-log", action="store_true", help="Flush the CSV log after every rename (slower, but current even if killed).")
     args = ap.parse_args()
 
     # Undo mode
@@ -361,7 +590,7 @@ def main() -> int:
 
     # Apply
     print("\nApplying rename...")
-    apply_plan(plan, log_path)
+    apply_plan(plan, log_path, sync_log=bool(args.sync_log))
     print(f"Done. Renamed {len(plan)} files. Log saved to: {log_path}")
     return 0
 